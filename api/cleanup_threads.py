@@ -1,11 +1,28 @@
 from http.server import BaseHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs, urlencode
-from urllib.request import Request, urlopen
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, timezone
+import hmac
 import json
 import os
+import time
+
+import urllib3
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+    _loads = json.loads
 
 DISCORD_API_BASE = "https://discord.com/api/v10"
+DISCORD_EPOCH_MS = 1420070400000
 
 DISCORD_BOT_TOKEN = os.environ.get("DISCORD_BOT_TOKEN")
 DISCORD_CHANNEL_ID = os.environ.get("DISCORD_CHANNEL_ID")
@@ -13,10 +30,38 @@ DISCORD_GUILD_ID = os.environ.get("DISCORD_GUILD_ID")
 SHARED_SECRET = os.environ.get("SHARED_SECRET")
 
 GUILD_PRIVATE_THREAD = 12  # Discord type for private threads
+ARCHIVED_MAX_PAGES = 20  # 100 threads per page
+ACTIVE_CACHE_TTL = 30  # seconds; absorbs back-to-back cron retries
+DELETE_WORKERS = 8  # concurrent DELETEs; kept low for Discord's per-route limit
+
+DISCORD_HEADERS = {
+    "Authorization": f"Bot {DISCORD_BOT_TOKEN}",
+    "User-Agent": "ShowdownCleanupBot (cleanup_threads.py)",
+    "Content-Type": "application/json",
+}
+
+# (guild_id, "active") -> (fetched_at_monotonic, threads). Lives as long as
+# the warm instance does.
+_ACTIVE_CACHE: dict[tuple, tuple[float, list]] = {}
+
+# One pool for every Discord call so listing + deletes share a keep-alive
+# connection instead of paying a TLS handshake each. Module-level, so it also
+# survives across warm invocations. Retry honours Discord's Retry-After on 429.
+_HTTP = urllib3.PoolManager(
+    num_pools=1,
+    maxsize=16,
+    headers=DISCORD_HEADERS,
+    retries=Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False,
+    ),
+)
 
 
 def _json_response(handler, status: int, payload: dict):
-    body = json.dumps(payload).encode("utf-8")
+    body = _dumps(payload)
     handler.send_response(status)
     handler.send_header("Content-Type", "application/json")
     handler.send_header("Content-Length", str(len(body)))
@@ -32,6 +77,11 @@ def _get_cutoff(days: int) -> datetime:
     return datetime.now(timezone.utc) - timedelta(days=days)
 
 
+def _snowflake_at(ms: int) -> int:
+    """Smallest snowflake that could have been generated at `ms` (epoch millis)."""
+    return (ms - DISCORD_EPOCH_MS) << 22
+
+
 def _parse_days_from_query(path: str) -> int:
     parsed = urlparse(path)
     qs = parse_qs(parsed.query)
@@ -52,34 +102,77 @@ def _verify_secret(headers) -> bool:
         return True
 
     provided = headers.get("X-Shared-Secret") or headers.get("x-shared-secret")
-    return provided is not None and provided == SHARED_SECRET
+    return provided is not None and hmac.compare_digest(
+        provided.encode("utf-8"), SHARED_SECRET.encode("utf-8")
+    )
 
 
 
-def _discord_headers():
+def _discord_request(method: str, path: str, params: dict | None = None):
     if not DISCORD_BOT_TOKEN:
         raise RuntimeError("DISCORD_BOT_TOKEN is not set")
-    return {
-        "Authorization": f"Bot {DISCORD_BOT_TOKEN}",
-        "User-Agent": "ShowdownCleanupBot (cleanup_threads.py)",
-        "Content-Type": "application/json",
-    }
-
-
-def _discord_request(method: str, path: str, params: dict | None = None):
     url = DISCORD_API_BASE + path
-    if params:
-        url += "?" + urlencode(params)
 
-    req = Request(url, method=method, headers=_discord_headers())
     try:
-        with urlopen(req, timeout=10) as resp:
-            status = resp.getcode()
-            data = resp.read().decode("utf-8")
+        resp = _HTTP.request(method, url, fields=params, timeout=10)
     except Exception as e:
         raise RuntimeError(f"HTTP error calling {url}: {e}") from e
 
-    return status, data
+    return resp.status, resp.data
+
+
+def _is_channel_private_thread(t: dict) -> bool:
+    return (
+        t.get("type") == GUILD_PRIVATE_THREAD
+        and str(t.get("parent_id")) == str(DISCORD_CHANNEL_ID)
+    )
+
+
+def _list_active_threads():
+    key = (DISCORD_GUILD_ID, "active")
+    hit = _ACTIVE_CACHE.get(key)
+    if hit and time.monotonic() - hit[0] < ACTIVE_CACHE_TTL:
+        return hit[1]
+
+    status, data = _discord_request("GET", f"/guilds/{DISCORD_GUILD_ID}/threads/active")
+    if status != 200:
+        raise RuntimeError(f"Discord API error (guild active) {status}: {data[:300].decode(errors='replace')}")
+
+    # The guild listing spans every channel; keep only ours so neither the
+    # cache nor the caller holds on to the rest.
+    obj = _loads(data)
+    threads = obj.get("threads", []) if isinstance(obj, dict) else obj
+    threads = [t for t in threads if _is_channel_private_thread(t)]
+    _ACTIVE_CACHE[key] = (time.monotonic(), threads)
+    return threads
+
+
+def _fetch_archived_private_threads():
+    """
+    Page through /channels/{channel_id}/threads/archived/private. Discord sorts
+    by archive_timestamp (newest first) and takes that timestamp as the
+    `before` cursor for the next page.
+    """
+    path = f"/channels/{DISCORD_CHANNEL_ID}/threads/archived/private"
+    params = {"limit": 100}
+    threads: list[dict] = []
+
+    for _ in range(ARCHIVED_MAX_PAGES):
+        status, data = _discord_request("GET", path, params=params)
+        if status != 200:
+            raise RuntimeError(f"Discord API error (archived/private) {status}: {data[:300].decode(errors='replace')}")
+
+        obj = _loads(data)
+        page = obj.get("threads", []) if isinstance(obj, dict) else obj
+        threads.extend(t for t in page if _is_channel_private_thread(t))
+
+        has_more = isinstance(obj, dict) and obj.get("has_more")
+        before = page and (page[-1].get("thread_metadata") or {}).get("archive_timestamp")
+        if not (has_more and before):
+            break
+        params = {"limit": 100, "before": before}
+
+    return threads
 
 
 def _fetch_private_threads():
@@ -93,34 +186,14 @@ def _fetch_private_threads():
     if not DISCORD_CHANNEL_ID:
         raise RuntimeError("DISCORD_CHANNEL_ID is not set")
 
-    all_threads: list[dict] = []
-
+    # The two listings are independent, so fetch them side by side.
     # 1) Guild-wide active threads
-    path_active = f"/guilds/{DISCORD_GUILD_ID}/threads/active"
-    status_a, data_a = _discord_request("GET", path_active)
-    if status_a != 200:
-        raise RuntimeError(f"Discord API error (guild active) {status_a}: {data_a[:300]}")
-
-    obj_a = json.loads(data_a)
-    threads_a = obj_a.get("threads", []) if isinstance(obj_a, dict) else obj_a
-    all_threads.extend(threads_a)
-
     # 2) Archived private threads for this channel
-    path_arch = f"/channels/{DISCORD_CHANNEL_ID}/threads/archived/private"
-    status_p, data_p = _discord_request("GET", path_arch, params={"limit": 100})
-    if status_p != 200:
-        raise RuntimeError(f"Discord API error (archived/private) {status_p}: {data_p[:300]}")
-
-    obj_p = json.loads(data_p)
-    threads_p = obj_p.get("threads", []) if isinstance(obj_p, dict) else obj_p
-    all_threads.extend(threads_p)
-
-    # Filter: private threads in our channel
-    private_threads = [
-        t for t in all_threads
-        if t.get("type") == GUILD_PRIVATE_THREAD
-        and str(t.get("parent_id")) == str(DISCORD_CHANNEL_ID)
-    ]
+    # Both come back already filtered to private threads in our channel.
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fa = ex.submit(_list_active_threads)
+        fp = ex.submit(_fetch_archived_private_threads)
+        private_threads = fa.result() + fp.result()
 
     return private_threads
 
@@ -131,32 +204,34 @@ def _delete_thread(thread_id: str):
 
     if status not in (204, 404):
         raise RuntimeError(
-            f"Failed to delete thread {thread_id}: {status} {data[:300]}"
+            f"Failed to delete thread {thread_id}: {status} {data[:300].decode(errors='replace')}"
         )
 
 
 def _cleanup(days: int):
     cutoff = _get_cutoff(days)
+    cutoff_snowflake = _snowflake_at(int(cutoff.timestamp() * 1000))
     threads = _fetch_private_threads()
 
     deleted = 0
+    victims: list[str] = []
     errors: list[str] = []
-    debug_list: list[dict] = []
-
-    for t in threads:
-        meta = t.get("thread_metadata") or {}
-        archive_ts = meta.get("archive_timestamp")
-
-        if len(debug_list) < 20:
-            debug_list.append(
-                {
-                    "id": t.get("id"),
-                    "name": t.get("name"),
-                    "archive_timestamp": archive_ts,
-                    "archived": meta.get("archived"),
-                }
-            )
+    debug_list = [
+        {
+            "id": t.get("id"),
+            "name": t.get("name"),
+            "archive_timestamp": (t.get("thread_metadata") or {}).get("archive_timestamp"),
+            "archived": (t.get("thread_metadata") or {}).get("archived"),
+        }
+        for t in threads[:20]
+    ]
+
+    # A thread can't be archived before it was created, so anything created
+    # after the cutoff is dropped here without parsing its timestamp.
+    candidates = [t for t in threads if int(t["id"]) < cutoff_snowflake]
 
+    for t in candidates:
+        archive_ts = (t.get("thread_metadata") or {}).get("archive_timestamp")
         if not archive_ts:
             continue
 
@@ -168,11 +243,19 @@ def _cleanup(days: int):
             continue
 
         if ts < cutoff:
-            try:
-                _delete_thread(t["id"])
-                deleted += 1
-            except Exception as e:
-                errors.append(f"delete {t.get('id')}: {e}")
+            victims.append(t["id"])
+
+    if victims:
+        with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as ex:
+            futures = {ex.submit(_delete_thread, tid): tid for tid in victims}
+            for fut in as_completed(futures):
+                try:
+                    fut.result()
+                    deleted += 1
+                except Exception as e:
+                    errors.append(f"delete {futures[fut]}: {e}")
+        # The cached active listing may now name deleted threads.
+        _ACTIVE_CACHE.clear()
 
     return {
         "channel_id": DISCORD_CHANNEL_ID,
@@ -3,7 +3,15 @@
 # Triggers via Vercel Cron (see vercel.json) or manual POST with X-Shared-Secret.
 
 from http.server import BaseHTTPRequestHandler
-import os, json, urllib.request, urllib.parse, base64, datetime, time, sys
+import os, io, re, json, hmac, urllib.parse, base64, calendar, datetime, sys, threading
+import urllib3
+from urllib3.util.retry import Retry
+try:
+    import orjson
+    _dumps, _loads = orjson.dumps, orjson.loads
+except ImportError:   # stdlib fallback; same bytes-in/bytes-out shape
+    def _dumps(obj): return json.dumps(obj).encode("utf-8")
+    _loads = json.loads
 
 def _clean(v: str) -> str:
     return (v or "").strip().strip('"').strip("'")
@@ -21,45 +29,85 @@ EMAIL_TO       = _clean(os.getenv("EMAIL_TO", ""))     # single recipient addres
 SHARED_SECRET  = _clean(os.getenv("SHARED_SECRET", ""))
 
 Q_ZSET = "queue:durations"
+ZRANGE_PAGE = 1000
+# Members are our own {"start","end","dur"} blobs; pull `end` out without a full parse
+_END_RE = re.compile(r'"end"\s*:\s*"?(-?\d+)')
+
+RESEND_URL = "https://api.resend.com"
+
+# One connection pool per host, parsed once at import and kept at module scope
+# so warm invocations reuse it. Upstash reads are idempotent, so transient
+# 429/5xx get two jittered retries.
+_UPSTASH = urllib3.connection_from_url(
+    UPSTASH_REDIS_REST_URL, maxsize=4, block=False,
+    headers={"Authorization": f"Bearer {UPSTASH_REDIS_REST_TOKEN}"},
+    retries=Retry(total=2, backoff_factor=0.1, backoff_jitter=0.1,
+                  status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False),
+    timeout=urllib3.Timeout(connect=2, read=15)) if UPSTASH_REDIS_REST_URL else None
+_RESEND = urllib3.connection_from_url(RESEND_URL, maxsize=2, block=False,
+                                      timeout=urllib3.Timeout(connect=2, read=30))
+
+# Sending mail is not idempotent: only retry a 429 (request was rejected, not
+# processed) and never after a read error, which could mean it was sent.
+_RESEND_RETRY = Retry(total=2, read=0, backoff_factor=0.5, backoff_jitter=0.25,
+                      status_forcelist=(429,), allowed_methods=None, raise_on_status=False)
+
+def _warm_resend():
+    # Open the TLS connection to Resend while Upstash is being paged, so the
+    # send at the end reuses it from the pool instead of handshaking then.
+    try:
+        _RESEND.request("HEAD", "/", retries=False)
+    except Exception as e:
+        print(f"[email] resend warm-up failed: {e}", file=sys.stderr)
 
 def _respond(h, status=200, obj=None):
-    h.send_response(status); h.send_header("Content-Type","application/json")
-    h.end_headers(); h.wfile.write(json.dumps(obj if obj is not None else {"ok": True}).encode("utf-8"))
+    body = _dumps(obj if obj is not None else {"ok": True})
+    h.send_response(status); h.send_header("Content-Type","application/json"); h.send_header("Content-Length", str(len(body)))
+    h.end_headers(); h.wfile.write(body)
 
 # ----- Upstash helpers (path-style REST)
 def _u_req(path: str):
-    req = urllib.request.Request(
-        f"{UPSTASH_REDIS_REST_URL}{path}",
-        headers={"Authorization": f"Bearer {UPSTASH_REDIS_REST_TOKEN}"}
-    )
-    with urllib.request.urlopen(req, timeout=15) as r:
-        return r.read().decode("utf-8")
-
-def _zrangebyscore(key: str, mn: int, mx: int):
+    if _UPSTASH is None:
+        raise RuntimeError("UPSTASH_REDIS_REST_URL not set")
+    r = _UPSTASH.request("GET", path)
+    if r.status >= 300:
+        raise RuntimeError(f"Upstash HTTP {r.status}: {r.data[:300].decode(errors='replace')}")
+    return r.data
+
+def _zrangebyscore_paged(key: str, mn: int, mx: int, page: int = ZRANGE_PAGE):
+    """Yield members in score order, fetching `page` at a time via LIMIT offset count.
+
+    A failed page raises instead of ending the iteration, so a partial day is
+    never mistaken for a complete one.
+    """
     k = urllib.parse.quote(key, safe="")
     mn_s, mx_s = str(int(mn)), str(int(mx))
-    try:
-        res = json.loads(_u_req(f"/zrangebyscore/{k}/{mn_s}/{mx_s}")).get("result") or []
-        return res
-    except Exception as e:
-        print(f"[upstash] zrangebyscore error: {e}", file=sys.stderr)
-        return []
+    off = 0
+    while True:
+        obj = _loads(_u_req(f"/zrangebyscore/{k}/{mn_s}/{mx_s}/LIMIT/{off}/{page}"))
+        if obj.get("error"):
+            raise RuntimeError(f"Upstash zrangebyscore error: {obj['error']}")
+        res = obj.get("result") or []
+        yield from res
+        if len(res) < page:
+            return
+        off += page
 
 # ----- Date window: previous UTC day
 def _prev_utc_day():
     # [00:00:00 .. 23:59:59] UTC of the day before today
-    today = datetime.datetime.utcnow().date()
+    today = datetime.datetime.now(datetime.timezone.utc).date()
     prev  = today - datetime.timedelta(days=1)
-    start = int(datetime.datetime(prev.year, prev.month, prev.day, 0, 0, 0).timestamp())
-    end   = int(datetime.datetime(prev.year, prev.month, prev.day, 23, 59, 59).timestamp())
+    # timegm treats the tuple as UTC; naive .timestamp() would use local time
+    start = calendar.timegm((prev.year, prev.month, prev.day, 0, 0, 0, 0, 0, 0))
+    end   = start + 86399
     return prev.isoformat(), start, end
 
 # ----- Resend email
-def _send_resend_email(subject: str, text_body: str, attachment_filename: str, attachment_text: str):
+def _send_resend_email(subject: str, text_body: str, attachment_filename: str, attachment):
     if not (RESEND_API_KEY and EMAIL_FROM and EMAIL_TO):
         raise RuntimeError("Resend config missing (RESEND_API_KEY / EMAIL_FROM / EMAIL_TO)")
 
-    url = "https://api.resend.com/emails"
     payload = {
         "from": EMAIL_FROM,
         "to": [EMAIL_TO],
@@ -67,23 +115,28 @@ def _send_resend_email(subject: str, text_body: str, attachment_filename: str, a
         "text": text_body,
         "attachments": [{
             "filename": attachment_filename,
-            # Resend expects base64-encoded content
-            "content": base64.b64encode(attachment_text.encode("utf-8")).decode("ascii")
+            # Resend expects base64-encoded content; spliced in below
+            "content": "__B64__"
         }]
     }
-    body = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        url,
-        data=body,
-        method="POST",
+    # Base64 is JSON-safe, so splice the encoded attachment into the dumped
+    # envelope instead of round-tripping the big string through the encoder.
+    head, _, tail = _dumps(payload).rpartition(b'"__B64__"')
+    body = b"".join((head, b'"', base64.b64encode(attachment), b'"', tail))
+    r = _RESEND.request(
+        "POST",
+        "/emails",
+        body=body,
         headers={
             "Authorization": f"Bearer {RESEND_API_KEY}",
             "Content-Type": "application/json",
             "Accept": "application/json"
-        }
+        },
+        retries=_RESEND_RETRY,
     )
-    with urllib.request.urlopen(req, timeout=30) as r:
-        return json.loads(r.read().decode() or "{}")
+    if r.status >= 300:
+        raise RuntimeError(f"Resend HTTP {r.status}: {r.data[:300].decode(errors='replace')}")
+    return _loads(r.data or b"{}")
 
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -92,33 +145,43 @@ class handler(BaseHTTPRequestHandler):
         return _respond(self, 200, {"ok": True, "prev_day_utc": day, "from": mn, "to": mx})
 
     def do_POST(self):
-        if SHARED_SECRET and self.headers.get("X-Shared-Secret","") != SHARED_SECRET:
+        if SHARED_SECRET and not hmac.compare_digest(self.headers.get("X-Shared-Secret","").encode(), SHARED_SECRET.encode()):
             return _respond(self, 401, {"error":"unauthorized"})
 
+        warm = threading.Thread(target=_warm_resend, daemon=True)
+        if RESEND_API_KEY:
+            warm.start()
+
         # Build export
         day, mn, mx = _prev_utc_day()
-        rows = _zrangebyscore(Q_ZSET, mn, mx)
-
-        # JSONL lines with trailing tab + end_ts (your requested format)
-        lines = []
-        for s in rows:
-            try:
-                obj = json.loads(s)
-                end_ts = obj.get("end", "")
-                lines.append(f"{s}\t{end_ts}")
-            except Exception:
-                lines.append(f"{s}\t")
-        content = "\n".join(lines) + ("\n" if lines else "")
+
+        # JSONL lines with trailing tab + end_ts (your requested format),
+        # written page by page straight into the attachment buffer
+        buf = io.BytesIO()
+        count = 0
+        try:
+            for s in _zrangebyscore_paged(Q_ZSET, mn, mx):
+                count += 1
+                m = _END_RE.search(s)
+                buf.write(s.encode("utf-8")); buf.write(b"\t")
+                if m: buf.write(m.group(1).encode())
+                buf.write(b"\n")
+        except Exception as e:
+            # Don't mail a silently truncated day; a 500 lets the cron be rerun
+            print(f"[upstash] export failed after {count} sessions: {e}", file=sys.stderr)
+            return _respond(self, 500, {"error": "export_failed"})
 
         subject = f"Queue sessions export {day} (UTC)"
         text = (
             f"Attached is the JSONL export for {day} UTC.\n"
-            f"Sessions: {len(rows)}\n\n"
+            f"Sessions: {count}\n\n"
             f"Format per line: {{start, end, dur}}\\t<end_ts>\n"
         )
+        if warm.is_alive():
+            warm.join(2)   # a handshake already in flight beats starting a second one
         try:
-            resp = _send_resend_email(subject, text, f"{day}.jsonl", content)
-            return _respond(self, 200, {"ok": True, "sent": True, "day": day, "count": len(rows), "resend": resp})
+            resp = _send_resend_email(subject, text, f"{day}.jsonl", buf.getbuffer())
+            return _respond(self, 200, {"ok": True, "sent": True, "day": day, "count": count, "resend": resp})
         except Exception as e:
             print("[email] send failed:", e, file=sys.stderr)
             return _respond(self, 500, {"error":"email_failed"})
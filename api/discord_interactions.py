@@ -1,8 +1,17 @@
 # api/discord_interactions.py
-# Discord Interactions handler: /link, /whois, /unlink
+# Discord Interactions handler: /link, /whois, /unlink, /queuestats
 from http.server import BaseHTTPRequestHandler
-import os, json, urllib.request, urllib.parse, sys, time
+import os, re, json, random, hashlib, urllib.parse, sys, time, logging
+import urllib3
+from json.encoder import encode_basestring
+from contextvars import ContextVar
 from nacl.signing import VerifyKey
+try:
+    import orjson
+    _dumps, _loads = orjson.dumps, orjson.loads
+except ImportError:   # stdlib fallback; same bytes-in/bytes-out shape
+    def _dumps(obj): return json.dumps(obj).encode("utf-8")
+    _loads = json.loads
 
 def _clean(v: str) -> str:
     return (v or "").strip().strip('"').strip("'")
@@ -10,50 +19,181 @@ def _clean(v: str) -> str:
 DISCORD_PUBLIC_KEY = _clean(os.getenv("DISCORD_PUBLIC_KEY", ""))
 UPSTASH_URL        = _clean(os.getenv("UPSTASH_REDIS_REST_URL", ""))
 UPSTASH_TOKEN      = _clean(os.getenv("UPSTASH_REDIS_REST_TOKEN", ""))
+LOG_LEVEL          = _clean(os.getenv("LOG_LEVEL", "WARNING")).upper()
+
+# Upstash traces are DEBUG; the default WARNING only reports outages
+log = logging.getLogger("discord_interactions")
+if not log.handlers:
+    _h = logging.StreamHandler(sys.stderr)
+    _h.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(_h)
+    log.propagate = False
+_lvl = logging.getLevelName(LOG_LEVEL)
+log.setLevel(_lvl if isinstance(_lvl, int) else logging.WARNING)
 
 PING, PONG = 1, 1
 APP_CMD = 2
 CH_MSG = 4
 EPHEMERAL = 1 << 6
 ADMINISTRATOR = 0x00000008
+MAX_BODY = 64 * 1024   # interactions are a few KB at most
+
+# Upstash key prefixes
+PLK, ULK, UML, UNL = "playerlink:", "userlink:", "usermeta:", "usernamelink:"
+
+# Shared across calls (and warm invocations) so the 3-5 Upstash hops per
+# command reuse one TLS connection instead of handshaking each time. The URL is
+# parsed once here; per call only the path changes.
+_U_AUTH      = {"Authorization": f"Bearer {UPSTASH_TOKEN}"}
+_U_AUTH_JSON = {**_U_AUTH, "Content-Type": "application/json"}
+_UPSTASH = urllib3.connection_from_url(UPSTASH_URL, maxsize=8, block=False, retries=False,
+                                       timeout=urllib3.Timeout(connect=1, read=2)) if UPSTASH_URL else None
+
+# Upstash retry budget: do_POST gives each interaction one UPSTASH_DEADLINE that
+# all of its Upstash calls, retries included, share, so the reply still fits
+# Discord's 3s interaction deadline. Reads retry 429/5xx and transport errors;
+# writes only retry what Upstash can't have executed (a refused/timed-out
+# connect, or a 429).
+UPSTASH_DEADLINE = 2.5
+_U_DEADLINE: ContextVar = ContextVar("_U_DEADLINE", default=0.0)   # 0: per-call budget
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RETRY_TRIES, RETRY_CAP = 3, 0.2
+# After BREAKER_THRESHOLD consecutive failed calls, fail fast for BREAKER_COOLDOWN s.
+BREAKER_THRESHOLD, BREAKER_COOLDOWN = 5, 30
+_BREAKER = {"fails": 0, "open_until": 0.0}
+
+class UpstashUnavailable(RuntimeError):
+    pass
+
+def respond_bytes(h, body: bytes, status=200):
+    h.send_response(status); h.send_header("Content-Type","application/json"); h.send_header("Content-Length", str(len(body)))
+    h.end_headers(); h.wfile.write(body)
 
 def respond_json(h, obj, status=200):
-    h.send_response(status); h.send_header("Content-Type","application/json")
-    h.end_headers(); h.wfile.write(json.dumps(obj).encode("utf-8"))
+    respond_bytes(h, _dumps(obj), status)
+
+# Discord health-checks with PINGs; the reply never changes, so encode it once.
+_PONG = _dumps({"type": PONG})
+
+# Every command reply has the same envelope; only the content string changes.
+_EPH_HEAD = b'{"type":%d,"data":{"flags":%d,"content":' % (CH_MSG, EPHEMERAL)
 
-def ephemeral(msg: str):
-    return {"type": CH_MSG, "data": {"content": msg, "flags": EPHEMERAL}}
+def respond_ephemeral(h, msg: str):
+    respond_bytes(h, _EPH_HEAD + encode_basestring(msg).encode("utf-8") + b"}}")
+
+def _load_verify_key():
+    try: return VerifyKey(bytes.fromhex(DISCORD_PUBLIC_KEY))
+    except Exception: return None
+
+# The public key is fixed per deployment: decode it once, not per request.
+_VERIFY_KEY = _load_verify_key()
 
 def verify_signature(body: bytes, sig_hex: str, ts: str) -> bool:
+    # Ed25519 signatures are 64 bytes (128 hex chars) and timestamps are short
+    # decimal strings; reject anything else before doing any curve math.
+    if _VERIFY_KEY is None or len(sig_hex) != 128 or not 0 < len(ts) <= 20 or len(body) < 2:
+        return False
     try:
-        VerifyKey(bytes.fromhex(DISCORD_PUBLIC_KEY)).verify(ts.encode() + body, bytes.fromhex(sig_hex))
+        _VERIFY_KEY.verify(ts.encode() + body, bytes.fromhex(sig_hex))
         return True
     except Exception:
         return False
 
 # --- Upstash helpers ---
+def _u_http(method: str, path: str, body: bytes = None, idempotent: bool = False):
+    """Upstash call with full-jitter retries inside the interaction's deadline and a consecutive-failure breaker.
+    Non-idempotent calls (writes, EVAL) are only retried when they can't have run."""
+    if _UPSTASH is None:
+        raise UpstashUnavailable("UPSTASH_REDIS_REST_URL not set")
+    if time.time() < _BREAKER["open_until"]:
+        raise UpstashUnavailable("circuit open")
+    headers = _U_AUTH if body is None else _U_AUTH_JSON
+    deadline = _U_DEADLINE.get() or time.monotonic() + UPSTASH_DEADLINE
+    for i in range(RETRY_TRIES):
+        left = deadline - time.monotonic()
+        if left <= 0:
+            err = "deadline exceeded"; break
+        try:
+            r = _UPSTASH.request(method, path, body=body, headers=headers,
+                                 timeout=urllib3.Timeout(connect=min(1, left), total=left))
+            if r.status not in RETRY_STATUS:
+                _BREAKER["fails"] = 0
+                return r
+            err = f"HTTP {r.status}"
+            if not idempotent and r.status != 429:
+                break
+        except urllib3.exceptions.ConnectTimeoutError as e:    # includes refused connects
+            err = str(e)
+        except urllib3.exceptions.HTTPError as e:
+            err = str(e)
+            if not idempotent:
+                break
+        if i < RETRY_TRIES - 1:
+            time.sleep(min(random.uniform(0, min(RETRY_CAP, 0.02 * 2 ** i)), max(0, deadline - time.monotonic())))
+    _BREAKER["fails"] += 1
+    if _BREAKER["fails"] >= BREAKER_THRESHOLD:
+        _BREAKER["open_until"] = time.time() + BREAKER_COOLDOWN
+    raise UpstashUnavailable(f"{method} {path}: {err}")
+
 def _u_req(path: str):
-    req = urllib.request.Request(
-        f"{UPSTASH_URL}{path}",
-        headers={"Authorization": f"Bearer {UPSTASH_TOKEN}"}
-    )
-    with urllib.request.urlopen(req, timeout=8) as r:
-        return r.read().decode("utf-8")
+    return _u_http("GET", path, idempotent=True).data
 
-def u_set(key: str, value: str):
-    k = urllib.parse.quote(key, safe=""); v = urllib.parse.quote(value, safe="")
-    body = _u_req(f"/set/{k}/{v}"); print(f"[upstash] SET {key} -> {body}"); return json.loads(body).get("result")=="OK"
+# Keys are almost always ids / lowercased names that need no escaping
+_QUOTE_SAFE_RE = re.compile(r"[A-Za-z0-9_:.\-]+")
+
+def _q(key: str) -> str:
+    return key if _QUOTE_SAFE_RE.fullmatch(key) else urllib.parse.quote(key, safe="")
 
 def u_get(key: str):
-    k = urllib.parse.quote(key, safe="")
-    body = _u_req(f"/get/{k}"); print(f"[upstash] GET {key} -> {body}")
-    return json.loads(body).get("result")
+    body = _u_req(f"/get/{_q(key)}")
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("[upstash] GET %s -> %s", key, body[:200].decode(errors='replace'))
+    return _loads(body).get("result")
+
+def _u_zrangebyscore(key: str, min_score: int, max_score: int):
+    body = _u_req(f"/zrangebyscore/{_q(key)}/{int(min_score)}/{int(max_score)}")
+    return _loads(body).get("result") or []
+
+def u_pipeline(cmds, idempotent: bool = False):
+    """Run several commands in one round trip; returns the per-command results in order.
+    Pass idempotent=True for batches that are safe to replay so they get the full retry policy.
+    Raises UpstashUnavailable on a non-2xx reply, an unexpected body or any command error."""
+    r = _u_http("POST", "/pipeline", _dumps(cmds), idempotent)
+    body = r.data
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("[upstash] PIPELINE %s -> %s", [c[0] for c in cmds], body[:200].decode(errors='replace'))
+    try: out = _loads(body)
+    except ValueError: out = None
+    if r.status >= 300 or not isinstance(out, list) or len(out) != len(cmds) \
+            or not all(isinstance(res, dict) and "error" not in res for res in out):
+        raise UpstashUnavailable(f"PIPELINE: HTTP {r.status} {body[:200].decode(errors='replace')}")
+    return [res.get("result") for res in out]
 
-def u_del(key: str):
-    k = urllib.parse.quote(key, safe="")
-    body = _u_req(f"/del/{k}"); print(f"[upstash] DEL {key} -> {body}")
-    try: return int(json.loads(body).get("result") or 0) > 0
-    except: return False
+# Check-and-set for /link in one atomic round trip, so two concurrent /link
+# calls can't both pass the existence checks and break the 1-to-1 mapping.
+# KEYS: player, user, meta[, username]  ARGV: player blob, player name, meta blob
+_LINK_LUA = """
+local cur = redis.call('GET', KEYS[2])
+if cur then return {'user', cur} end
+if redis.call('EXISTS', KEYS[1]) == 1 then return {'player', ''} end
+redis.call('SET', KEYS[1], ARGV[1])
+redis.call('SET', KEYS[2], ARGV[2])
+redis.call('SET', KEYS[3], ARGV[3])
+if KEYS[4] then redis.call('SET', KEYS[4], ARGV[2]) end
+return {'ok', ''}
+"""
+_LINK_SHA = hashlib.sha1(_LINK_LUA.encode()).hexdigest()
+
+def u_eval(script: str, sha: str, keys, args):
+    """EVALSHA, loading the script with EVAL only if Upstash doesn't have it cached yet."""
+    tail = [len(keys), *keys, *args]
+    res = _loads(_u_http("POST", "/", _dumps(["EVALSHA", sha, *tail])).data)
+    if "NOSCRIPT" in str(res.get("error", "")):
+        res = _loads(_u_http("POST", "/", _dumps(["EVAL", script, *tail])).data)
+    log.debug("[upstash] EVAL %.8s -> %s", sha, res)
+    if "error" in res:
+        raise UpstashUnavailable(f"EVAL: {res['error']}")
+    return res.get("result")
 
 # --- Link storage ---
 def save_link(playername: str, user_id: str, display_name: str, username: str):
@@ -66,128 +206,145 @@ def save_link(playername: str, user_id: str, display_name: str, username: str):
     player_lc   = player_norm.lower()
     uname_lc    = (username or "").strip().lower()
 
+    # keys
+    player_key = PLK + player_lc
+    user_key   = ULK + user_id
+    uname_key  = UNL + uname_lc if uname_lc else None
+    meta_key   = UML + user_id
+
+    player_blob = _dumps({"id": user_id, "username": username, "display": display_name}).decode()
+    meta_blob   = _dumps({"username": username, "display": display_name, "player": player_norm}).decode()
+
+    keys = [player_key, user_key, meta_key] + ([uname_key] if uname_key else [])
+    res = u_eval(_LINK_LUA, _LINK_SHA, keys, [player_blob, player_norm, meta_blob])
+    status, current = res if isinstance(res, list) and len(res) == 2 else (None, None)
+
     # check if this user already has a link
-    existing_player = u_get(f"userlink:{user_id}")
-    if existing_player:
-        return False, f"You already linked to **{existing_player}**. Unlink first."
+    if status == "user":
+        return False, f"You already linked to **{current}**. Unlink first."
 
     # check if this playername is already taken
-    existing = u_get(f"playerlink:{player_lc}")
-    if existing:
+    if status == "player":
         return False, f"Player **{player_norm}** is already linked to another Discord account."
 
-    # keys
-    player_key = f"playerlink:{player_lc}"
-    user_key   = f"userlink:{user_id}"
-    uname_key  = f"usernamelink:{uname_lc}" if uname_lc else None
-    meta_key   = f"usermeta:{user_id}"
-
-    player_blob = json.dumps({"id": user_id, "username": username, "display": display_name})
-    meta_blob   = json.dumps({"username": username, "display": display_name, "player": player_norm})
+    if status != "ok":
+        log.warning("[link] unexpected script result %r", res)
+        return False, "Couldn't save the link right now, please try again."
 
-    ok = True
-    ok &= u_set(player_key, player_blob)
-    ok &= u_set(user_key, player_norm)
-    if uname_key: ok &= u_set(uname_key, player_norm)
-    ok &= u_set(meta_key, meta_blob)
-    return ok, f"Linked **{player_norm}** to <@{user_id}> ✅"
+    return True, f"Linked **{player_norm}** to <@{user_id}> ✅"
 
 def read_player_link(playername: str):
     player_lc = playername.strip().lower()
-    raw = u_get(f"playerlink:{player_lc}")
+    raw = u_get(PLK + player_lc)
     if not raw: return None
     if isinstance(raw,str) and raw and raw[0] != "{":
         return {"id": raw, "username": None, "display": None, "player": playername}
     try:
-        blob = json.loads(raw); blob["player"] = playername; return blob
+        blob = _loads(raw); blob["player"] = playername; return blob
     except: return None
 
 def delete_player_link(playername: str):
     info = read_player_link(playername)
     player_lc = playername.strip().lower()
-    removed = u_del(f"playerlink:{player_lc}")
+    cmds = [["DEL", PLK + player_lc]]
     if info:
         uid = info.get("id"); uname = (info.get("username") or "").strip().lower()
-        if uid:   u_del(f"userlink:{uid}"); u_del(f"usermeta:{uid}")
-        if uname: u_del(f"usernamelink:{uname}")
-    return removed
+        if uid:   cmds += [["DEL", ULK + str(uid)], ["DEL", UML + str(uid)]]
+        if uname: cmds.append(["DEL", UNL + uname])
+    # DELs can be replayed safely; an Upstash failure raises UpstashUnavailable
+    deleted = u_pipeline(cmds, idempotent=True)[0]
+    try: return int(deleted or 0) > 0
+    except (TypeError, ValueError): return False
 
 # --- HTTP handler ---
 class handler(BaseHTTPRequestHandler):
     def do_POST(self):
+        _U_DEADLINE.set(time.monotonic() + UPSTASH_DEADLINE)
         sig = self.headers.get("X-Signature-Ed25519",""); ts = self.headers.get("X-Signature-Timestamp","")
-        body = self.rfile.read(int(self.headers.get("Content-Length","0") or 0))
+        try: n = int(self.headers["Content-Length"])
+        except (KeyError, TypeError, ValueError): n = -1
+        if n < 0: return respond_json(self, {"error":"length required"}, 411)
+        if n > MAX_BODY: return respond_json(self, {"error":"body too large"}, 413)
+        body = self.rfile.read(n)
         if not (sig and ts and verify_signature(body, sig, ts)):
             return respond_json(self, {"error":"bad signature"}, 401)
 
-        try: data = json.loads(body.decode("utf-8"))
+        try: data = _loads(body)
         except: return respond_json(self, {"error":"bad json"}, 400)
 
         if data.get("type") == PING:
-            return respond_json(self, {"type": PONG})
+            return respond_bytes(self, _PONG)
 
         if data.get("type") == APP_CMD:
-            cmd = (data.get("data") or {}).get("name","")
-            options = {o["name"]: o["value"] for o in (data.get("data") or {}).get("options", [])}
-
-            member = data.get("member", {}) or {}
-            user   = member.get("user") or data.get("user") or {}
-            user_id = user.get("id","")
-            username = user.get("username","")
-            display_name = member.get("nick") or user.get("global_name") or username or f"User {user_id}"
-            perms = int(member.get("permissions","0") or "0")
-
-            # /link
-            if cmd == "link":
-                playername = str(options.get("playername","")).strip()
-                if not playername: return respond_json(self, ephemeral("Usage: /link playername:<text>"))
-                ok, msg = save_link(playername, user_id, display_name, username)
-                return respond_json(self, ephemeral(msg))
-
-            # /whois
-            if cmd == "whois":
-                playername = str(options.get("playername","")).strip()
-                if not playername: return respond_json(self, ephemeral("Usage: /whois playername:<text>"))
-                info = read_player_link(playername)
-                if not info: return respond_json(self, ephemeral(f"**{playername}** is not linked."))
-                uid = info.get("id"); disp = info.get("display") or "(no display)"; uname = info.get("username") or "(no username)"
-                msg = f"**{playername}** → <@{uid}>  •  username: `{uname}`  •  display: `{disp}`"
-                return respond_json(self, ephemeral(msg))
-
-            # /unlink
-            if cmd == "unlink":
-                playername = str(options.get("playername","")).strip()
-                if not playername: return respond_json(self, ephemeral("Usage: /unlink playername:<text>"))
-                info = read_player_link(playername)
-                if not info: return respond_json(self, ephemeral(f"**{playername}** wasn’t linked."))
-                owner_id = info.get("id"); is_admin = (perms & ADMINISTRATOR)==ADMINISTRATOR
-                if user_id != owner_id and not is_admin:
-                    return respond_json(self, ephemeral("You can only unlink your own mapping (or be an admin)."))
-                delete_player_link(playername)
-                return respond_json(self, ephemeral(f"Unlinked **{playername}** ✅"))
-
-            elif cmd == "queuestats":
-                # Read last 48h directly from Upstash (same as queue_stats.py)
-                rows = _u_zrangebyscore("queue:durations", int(time.time()) - 48*3600, int(time.time()))
-                durs = []
-                by_hour = {h: [] for h in range(24)}
-                for s in rows:
-                    try:
-                        obj = json.loads(s); dur = int(obj.get("dur") or 0); end_ts = int(obj.get("end") or 0)
-                        if dur > 0 and end_ts > 0:
-                            durs.append(dur)
-                            by_hour[time.gmtime(end_ts).tm_hour].append(dur)
-                    except: pass
-                def _avg(lst): return round(sum(lst)/len(lst),2) if lst else 0.0
-                overall = _avg(durs); overall_min = round(overall/60.0,2)
-                # Pull current hour
-                curh = time.gmtime().tm_hour
-                curh_avg = _avg(by_hour[curh]); curh_min = round(curh_avg/60.0,2)
-                msg = (f"**Queue stats (last 48h, UTC)**\n"
-                       f"Sessions: {len(durs)}\n"
-                       f"Overall avg: {overall}s (~{overall_min}m)\n"
-                       f"This hour (UTC {curh:02d}): {curh_avg}s (~{curh_min}m)")
-                return respond_json(self, {"type": CH_MSG, "data": {"content": msg, "flags": EPHEMERAL}})
-
-
-        return respond_json(self, ephemeral("Unsupported interaction"))
+            try: return self._command(data)
+            except UpstashUnavailable as e:
+                log.warning("[upstash] unavailable: %s", e)
+                return respond_ephemeral(self, "Link storage is busy right now, please try again in a moment.")
+
+        return respond_ephemeral(self, "Unsupported interaction")
+
+    def _command(self, data):
+        cmd_data = data.get("data") or {}
+        cmd = cmd_data.get("name","")
+        # every command takes at most the one playername option
+        playername = str(next((o.get("value","") for o in cmd_data.get("options") or () if o.get("name") == "playername"), "")).strip()
+
+        member = data.get("member", {}) or {}
+        user   = member.get("user") or data.get("user") or {}
+        user_id = user.get("id","")
+        username = user.get("username","")
+        display_name = member.get("nick") or user.get("global_name") or username or f"User {user_id}"
+        perms = int(member.get("permissions","0") or "0")
+
+        # /link
+        if cmd == "link":
+            if not playername: return respond_ephemeral(self, "Usage: /link playername:<text>")
+            ok, msg = save_link(playername, user_id, display_name, username)
+            return respond_ephemeral(self, msg)
+
+        # /whois
+        if cmd == "whois":
+            if not playername: return respond_ephemeral(self, "Usage: /whois playername:<text>")
+            info = read_player_link(playername)
+            if not info: return respond_ephemeral(self, f"**{playername}** is not linked.")
+            uid = info.get("id"); disp = info.get("display") or "(no display)"; uname = info.get("username") or "(no username)"
+            msg = f"**{playername}** → <@{uid}>  •  username: `{uname}`  •  display: `{disp}`"
+            return respond_ephemeral(self, msg)
+
+        # /unlink
+        if cmd == "unlink":
+            if not playername: return respond_ephemeral(self, "Usage: /unlink playername:<text>")
+            info = read_player_link(playername)
+            if not info: return respond_ephemeral(self, f"**{playername}** wasn’t linked.")
+            owner_id = info.get("id"); is_admin = (perms & ADMINISTRATOR)==ADMINISTRATOR
+            if user_id != owner_id and not is_admin:
+                return respond_ephemeral(self, "You can only unlink your own mapping (or be an admin).")
+            if not delete_player_link(playername):
+                return respond_ephemeral(self, f"**{playername}** wasn’t linked.")
+            return respond_ephemeral(self, f"Unlinked **{playername}** ✅")
+
+        elif cmd == "queuestats":
+            # Read last 48h directly from Upstash (same as queue_stats.py)
+            now = int(time.time())
+            rows = _u_zrangebyscore("queue:durations", now - 48*3600, now)
+            durs = []
+            by_hour = [[] for _ in range(24)]   # UTC hour = (ts // 3600) % 24, no DST in UTC
+            for s in rows:
+                try:
+                    obj = _loads(s); dur = int(obj.get("dur") or 0); end_ts = int(obj.get("end") or 0)
+                    if dur > 0 and end_ts > 0:
+                        durs.append(dur)
+                        by_hour[(end_ts // 3600) % 24].append(dur)
+                except: pass
+            def _avg(lst): return round(sum(lst)/len(lst),2) if lst else 0.0
+            overall = _avg(durs); overall_min = round(overall/60.0,2)
+            # Pull current hour
+            curh = (now // 3600) % 24
+            curh_avg = _avg(by_hour[curh]); curh_min = round(curh_avg/60.0,2)
+            msg = (f"**Queue stats (last 48h, UTC)**\n"
+                   f"Sessions: {len(durs)}\n"
+                   f"Overall avg: {overall}s (~{overall_min}m)\n"
+                   f"This hour (UTC {curh:02d}): {curh_avg}s (~{curh_min}m)")
+            return respond_ephemeral(self, msg)
+
+        return respond_ephemeral(self, "Unsupported interaction")
@@ -1,6 +1,13 @@
 # api/queue_stats.py
 from http.server import BaseHTTPRequestHandler
-import os, json, urllib.request, urllib.parse, time, statistics
+import os, json, hmac, hashlib, urllib.parse, time
+import urllib3
+try:
+    import orjson
+    _dumps, _loads = orjson.dumps, orjson.loads
+except ImportError:   # stdlib fallback; same bytes-in/bytes-out shape
+    def _dumps(obj): return json.dumps(obj).encode("utf-8")
+    _loads = json.loads
 
 def _clean(v: str) -> str:
     return (v or "").strip().strip('"').strip("'")
@@ -12,55 +19,97 @@ SHARED_SECRET = _clean(os.getenv("SHARED_SECRET", ""))
 Q_ZSET        = "queue:durations"
 WINDOW_SEC    = 168 * 3600  # last 7 days
 
+# Module-level pool: warm invocations reuse the TLS connection to Upstash
+_U_AUTH      = {"Authorization": f"Bearer {UPSTASH_TOKEN}"}
+_U_AUTH_JSON = {**_U_AUTH, "Content-Type": "application/json"}
+_UPSTASH = urllib3.connection_from_url(UPSTASH_URL, maxsize=2, block=False, retries=False, headers=_U_AUTH,
+                                       timeout=urllib3.Timeout(connect=2, read=8)) if UPSTASH_URL else None
+
 def _respond(h, status=200, obj=None):
-    h.send_response(status); h.send_header("Content-Type","application/json")
-    h.end_headers(); h.wfile.write(json.dumps(obj if obj is not None else {"ok": True}).encode("utf-8"))
+    body = _dumps(obj if obj is not None else {"ok": True})
+    h.send_response(status); h.send_header("Content-Type","application/json"); h.send_header("Content-Length", str(len(body)))
+    h.end_headers(); h.wfile.write(body)
 
 def _u_req(path: str):
-    req = urllib.request.Request(f"{UPSTASH_URL}{path}", headers={"Authorization": f"Bearer {UPSTASH_TOKEN}"})
-    with urllib.request.urlopen(req, timeout=8) as r:
-        return r.read().decode("utf-8")
+    if _UPSTASH is None:
+        raise RuntimeError("UPSTASH_REDIS_REST_URL not set")
+    return _UPSTASH.request("GET", path).data
 
 def _u_zrangebyscore(key: str, min_score: int, max_score: int):
     k = urllib.parse.quote(key, safe=""); mn = str(int(min_score)); mx = str(int(max_score))
     try:
-        res = json.loads(_u_req(f"/zrangebyscore/{k}/{mn}/{mx}")).get("result") or []
+        res = _loads(_u_req(f"/zrangebyscore/{k}/{mn}/{mx}")).get("result") or []
         return res
     except:
         return []
 
+# Per-UTC-hour duration sums and counts, aggregated inside Upstash so only 48
+# numbers come back instead of every session blob in the window.
+_HOURLY_LUA = """
+local rows = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[2])
+local sums, cnts = {}, {}
+for i = 1, 24 do sums[i] = 0; cnts[i] = 0 end
+for _, s in ipairs(rows) do
+  local e = tonumber(string.match(s, '"end"%s*:%s*(%d+)'))
+  local d = tonumber(string.match(s, '"dur"%s*:%s*(%d+)'))
+  if e and d and e > 0 and d > 0 then
+    local h = math.floor(e / 3600) % 24 + 1
+    sums[h] = sums[h] + d; cnts[h] = cnts[h] + 1
+  end
+end
+return {sums, cnts}
+"""
+_HOURLY_SHA = hashlib.sha1(_HOURLY_LUA.encode()).hexdigest()
+
+def _u_eval(script: str, sha: str, keys, args):
+    tail = [len(keys), *keys, *args]
+    res = _loads(_UPSTASH.request("POST", "/", body=_dumps(["EVALSHA", sha, *tail]), headers=_U_AUTH_JSON).data)
+    if "NOSCRIPT" in str(res.get("error", "")):
+        res = _loads(_UPSTASH.request("POST", "/", body=_dumps(["EVAL", script, *tail]), headers=_U_AUTH_JSON).data)
+    if "error" in res:
+        raise RuntimeError(res["error"])
+    return res.get("result")
+
+def _hourly_totals(mn: int, mx: int):
+    """([sum]*24, [count]*24) over the window; falls back to aggregating rows here if EVAL fails."""
+    try:
+        sums, cnts = _u_eval(_HOURLY_LUA, _HOURLY_SHA, [Q_ZSET], [str(int(mn)), str(int(mx))])
+        return sums, cnts
+    except Exception:
+        pass
+    sums, cnts = [0] * 24, [0] * 24
+    for s in _u_zrangebyscore(Q_ZSET, mn, mx):
+        try:
+            obj = _loads(s)
+            dur = int(obj.get("dur") or 0)
+            end_ts = int(obj.get("end") or 0)
+            if dur <= 0 or end_ts <= 0:
+                continue
+            h = (end_ts // 3600) % 24  # UTC hour-of-day; no DST in UTC
+            sums[h] += dur; cnts[h] += 1
+        except Exception:
+            continue
+    return sums, cnts
+
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         # Optional: protect with the same shared secret header
-        if SHARED_SECRET and self.headers.get("X-Shared-Secret","") != SHARED_SECRET:
+        if SHARED_SECRET and not hmac.compare_digest(self.headers.get("X-Shared-Secret","").encode(), SHARED_SECRET.encode()):
             return _respond(self, 401, {"error":"unauthorized"})
 
         now = int(time.time())
-        rows = _u_zrangebyscore(Q_ZSET, now - WINDOW_SEC, now)
-
-        durations = []
-        by_hour = {h: [] for h in range(24)}  # UTC hours
-        for s in rows:
-            try:
-                obj = json.loads(s)
-                dur = int(obj.get("dur") or 0)
-                end_ts = int(obj.get("end") or 0)
-                if dur <= 0 or end_ts <= 0: 
-                    continue
-                durations.append(dur)
-                hour = time.gmtime(end_ts).tm_hour  # UTC hour-of-day
-                by_hour[hour].append(dur)
-            except Exception:
-                continue
+        sums, cnts = _hourly_totals(now - WINDOW_SEC, now)
+        count = sum(cnts)
 
-        def _avg(lst):
-            return round(statistics.mean(lst), 2) if lst else 0.0
+        def _avg(total, n):
+            return round(total / n, 2) if n else 0.0
 
+        avg = _avg(sum(sums), count)
         stats = {
             "window_hours": 168,
-            "count": len(durations),
-            "avg_sec": _avg(durations),
-            "avg_min": round((_avg(durations) / 60.0), 2),
-            "by_hour_utc": {str(h): _avg(by_hour[h]) for h in range(24)},
+            "count": count,
+            "avg_sec": avg,
+            "avg_min": round(avg / 60.0, 2),
+            "by_hour_utc": {str(h): _avg(sums[h], cnts[h]) for h in range(24)},
         }
         return _respond(self, 200, {"ok": True, "stats": stats})
@@ -2,7 +2,19 @@
 # (unchanged header comment omitted for brevity)
 
 from http.server import BaseHTTPRequestHandler
-import json, os, base64, urllib.request, urllib.parse, urllib.error, sys, traceback, time, math
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from contextvars import ContextVar
+from json.encoder import encode_basestring
+import json, os, re, base64, hmac, random, urllib.parse, sys, time, datetime, logging
+import urllib3
+from urllib3.util.retry import Retry
+try:
+    import orjson
+    _dumps, _loads = orjson.dumps, orjson.loads
+except ImportError:   # stdlib fallback; same bytes-in/bytes-out shape
+    def _dumps(obj): return json.dumps(obj).encode("utf-8")
+    _loads = json.loads
 
 def _clean(v: str) -> str:
     return (v or "").strip().strip('"').strip("'")
@@ -17,72 +29,150 @@ UPSTASH_TOKEN          = _clean(os.getenv("UPSTASH_REDIS_REST_TOKEN", ""))
 SHARED_SECRET          = _clean(os.getenv("SHARED_SECRET", ""))
 
 LFG_MESSAGE_TEXT       = _clean(os.getenv("LFG_MESSAGE_TEXT", "Someone is looking for a game!"))
+LOG_LEVEL              = _clean(os.getenv("LOG_LEVEL", "WARNING")).upper()
 THREAD_AUTO_ARCHIVE_MIN = 60
+MAX_BODY = 64 * 1024   # match/queue events are a few hundred bytes
+
+# Discord actions are INFO and per-request ingress/step traces DEBUG, so the
+# default WARNING keeps them (and their formatting) off stderr; errors and
+# failed Discord calls still show.
+log = logging.getLogger("showdown")
+if not log.handlers:
+    _h = logging.StreamHandler(sys.stderr)
+    _h.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(_h)
+    log.propagate = False
+_lvl = logging.getLevelName(LOG_LEVEL)
+log.setLevel(_lvl if isinstance(_lvl, int) else logging.WARNING)
 
 # ---- keys for queue analytics
 Q_ACTIVE_KEY    = "queue:active"          # "1" while queue is on
 Q_STARTED_AT    = "queue:started_at"      # unix seconds when queue turned on
 Q_ZSET          = "queue:durations"       # zset of session blobs, score=end_ts
+PLK             = "playerlink:"           # written by /link in discord_interactions
+
+# One pool per host, built once at import so warm invocations reuse the TLS
+# connections. Non-2xx replies come back as responses; callers check status.
+# Discord retries only cover urllib3's idempotent methods (GET/PUT/DELETE...),
+# so a message POST is never sent twice; 429s are left to the caller. Upstash
+# path-style writes are GETs too (/set, /incrby), so only reads opt in.
+DISCORD_API = "/api/v10"
+_DISCORD_RETRY  = Retry(total=2, backoff_factor=0.1, backoff_jitter=0.1, status_forcelist=(500, 502, 503, 504),
+                        raise_on_status=False)
+_UPSTASH_RETRY  = Retry(total=2, backoff_factor=0.1, backoff_jitter=0.1, status_forcelist=(429, 500, 502, 503, 504),
+                        raise_on_status=False)
+_BOT_HEADERS = {
+    "Authorization": f"Bot {DISCORD_BOT_TOKEN}",
+    "Content-Type": "application/json",
+    "Accept": "application/json, */*",
+    "User-Agent": "MatchNotifier (https://github.com/your-repo, 1.0)",
+}
+_DISCORD = urllib3.connection_from_url("https://discord.com", maxsize=8, block=False, retries=_DISCORD_RETRY,
+                                       headers=_BOT_HEADERS, timeout=urllib3.Timeout(connect=3, read=12))
+_WEBHOOK_URL = urllib3.util.parse_url(DISCORD_WEBHOOK) if DISCORD_WEBHOOK else None
+_WEBHOOK = urllib3.connection_from_url(DISCORD_WEBHOOK, maxsize=2, block=False, retries=False,
+                                       timeout=urllib3.Timeout(connect=3, read=12)) if DISCORD_WEBHOOK else None
+_U_AUTH      = {"Authorization": f"Bearer {UPSTASH_TOKEN}"}
+_U_AUTH_JSON = {**_U_AUTH, "Content-Type": "application/json"}
+_UPSTASH = urllib3.connection_from_url(UPSTASH_URL, maxsize=8, block=False, retries=False, headers=_U_AUTH,
+                                       timeout=urllib3.Timeout(connect=2, read=8)) if UPSTASH_URL else None
 
 # -------- HTTP helpers --------
 def _respond(h, status=200, obj=None):
-    h.send_response(status); h.send_header("Content-Type", "application/json")
-    h.end_headers(); h.wfile.write(json.dumps(obj if obj is not None else {"ok": True}).encode("utf-8"))
+    body = _dumps(obj if obj is not None else {"ok": True})
+    h.send_response(status); h.send_header("Content-Type", "application/json"); h.send_header("Content-Length", str(len(body)))
+    h.end_headers(); h.wfile.write(body)
 
 # -------- Upstash (path REST) --------
-def _u_req(path: str):
-    req = urllib.request.Request(f"{UPSTASH_URL}{path}", headers={"Authorization": f"Bearer {UPSTASH_TOKEN}"})
-    with urllib.request.urlopen(req, timeout=8) as r:
-        return r.read().decode("utf-8")
+def _u_req(path: str, retries=None, body: bytes = None):
+    """GET the command path; with a body, POST it and Upstash appends the body as the last argument."""
+    if _UPSTASH is None:
+        raise RuntimeError("UPSTASH_REDIS_REST_URL not set")
+    if body is not None:
+        return _UPSTASH.request("POST", path, body=body, retries=False).data
+    return _UPSTASH.request("GET", path, retries=retries).data
+
+# Keys/values are mostly ids and lowercased names that need no escaping;
+# threadpair keys only need their "|" separator escaped
+_QUOTE_SAFE_RE = re.compile(r"[A-Za-z0-9_:.\-|]+")
+
+@lru_cache(maxsize=1024)
+def _q(key: str) -> str:
+    return key.replace("|", "%7C") if _QUOTE_SAFE_RE.fullmatch(key) else urllib.parse.quote(key, safe="")
+
+def _extract_result(body: bytes):
+    """.result of an Upstash reply; plain strings and null are sliced out without a JSON parse."""
+    if body.startswith(b'{"result":"') and body.endswith(b'"}'):
+        inner = body[11:-2]
+        if b'"' not in inner and b"\\" not in inner:
+            return inner.decode()
+    elif body == b'{"result":null}':
+        return None
+    return _loads(body).get("result")
 
 def _u_get(key: str):
-    k = urllib.parse.quote(key, safe="")
-    try: return json.loads(_u_req(f"/get/{k}")).get("result")
+    k = _q(key)
+    try: return _extract_result(_u_req(f"/get/{k}", _UPSTASH_RETRY))
     except: return None
 
 def _u_set(key: str, val: str):
-    k = urllib.parse.quote(key, safe=""); v = urllib.parse.quote(val, safe="")
-    try: return json.loads(_u_req(f"/set/{k}/{v}")).get("result") == "OK"
+    k = _q(key)
+    try: return _loads(_u_req(f"/set/{k}", body=val.encode("utf-8"))).get("result") == "OK"
     except: return False
 
 def _u_del(key: str):
-    k = urllib.parse.quote(key, safe="")
-    try: return int(json.loads(_u_req(f"/del/{k}")).get("result") or 0) > 0
+    k = _q(key)
+    try: return int(_loads(_u_req(f"/del/{k}")).get("result") or 0) > 0
     except: return False
 
 def _u_zadd(key: str, score: int, member: str):
-    k = urllib.parse.quote(key, safe=""); s = str(int(score)); m = urllib.parse.quote(member, safe="")
-    try: return int(json.loads(_u_req(f"/zadd/{k}/{s}/{m}")).get("result") or 0) >= 0
+    k = _q(key); s = str(int(score))
+    try: return int(_loads(_u_req(f"/zadd/{k}/{s}", body=member.encode("utf-8"))).get("result") or 0) >= 0
     except: return False
 
 def _u_zrangebyscore(key: str, min_score: int, max_score: int):
-    k = urllib.parse.quote(key, safe=""); mn = str(int(min_score)); mx = str(int(max_score))
+    k = _q(key); mn = str(int(min_score)); mx = str(int(max_score))
     try:
-        res = json.loads(_u_req(f"/zrangebyscore/{k}/{mn}/{mx}")).get("result") or []
+        res = _loads(_u_req(f"/zrangebyscore/{k}/{mn}/{mx}", _UPSTASH_RETRY)).get("result") or []
         # Upstash returns an array of members (strings). We store JSON blobs.
         return res
     except:
         return []
 
-import time, datetime
-
 def _u_incrby(key: str, amount: int):
-    k = urllib.parse.quote(key, safe="")
+    k = _q(key)
     a = str(int(amount))
     try:
-        return json.loads(_u_req(f"/incrby/{k}/{a}")).get("result")
+        return _loads(_u_req(f"/incrby/{k}/{a}")).get("result")
     except:
         return None
 
+def _u_pipeline(cmds):
+    """Several commands in one round trip; per-command results in order, or None if
+    the request failed or any command errored (so callers can't mistake it for data)."""
+    try:
+        r = _UPSTASH.request("POST", "/pipeline", body=_dumps(cmds), headers=_U_AUTH_JSON)
+        if r.status >= 400:
+            log.warning("[upstash] pipeline HTTPError %s %s", r.status, r.data[:200].decode(errors="replace"))
+            return None
+        out = _loads(r.data)
+    except Exception as e:
+        log.warning("[upstash] pipeline failed: %s", e)
+        return None
+    if any("error" in res for res in out):
+        log.warning("[upstash] pipeline command error: %s", [res.get("error") for res in out])
+        return None
+    return [res.get("result") for res in out]
+
 def _today_utc():
-    return datetime.datetime.utcnow().strftime("%Y-%m-%d")
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d")
 
 def _log_queue_session(start_ts: int, end_ts: int):
     """Append raw session + bump daily counters."""
     if not (start_ts and end_ts and end_ts >= start_ts):
         return
     dur = end_ts - start_ts
-    blob = json.dumps({"start": start_ts, "end": end_ts, "dur": dur})
+    blob = _dumps({"start": start_ts, "end": end_ts, "dur": dur}).decode()
     _u_zadd("queue:durations", end_ts, blob)
     day = _today_utc()
     _u_incrby(f"queue:daily:{day}:count", 1)
@@ -91,149 +181,243 @@ def _log_queue_session(start_ts: int, end_ts: int):
 def _log_match_event(p1: str, p2: str, linked1: bool, linked2: bool, ts: int | None = None):
     """Append raw match event + bump daily counter."""
     ts = ts or int(time.time())
-    blob = json.dumps({"ts": ts, "p1": p1, "p2": p2, "linked": [bool(linked1), bool(linked2)]})
+    blob = _dumps({"ts": ts, "p1": p1, "p2": p2, "linked": [bool(linked1), bool(linked2)]}).decode()
     _u_zadd("matches:events", ts, blob)
     day = _today_utc()
     _u_incrby(f"matches:daily:{day}:count", 1)
 
 
 # -------- Player → Discord ID --------
-def _lookup_discord_id(player_name: str):
-    key = f"playerlink:{player_name.strip().lower()}"
-    try:
-        val = _u_get(key)
-        if not val: return None
-        if isinstance(val, str) and val.startswith("{"):
-            try: return json.loads(val).get("id")
-            except: return None
-        if isinstance(val, str): return val
-        return None
-    except: return None
+def _parse_link(val):
+    """playerlink values are either a bare Discord id or a JSON blob with an "id"."""
+    if not val or not isinstance(val, str): return None
+    if val.startswith("{"):
+        try: return _loads(val).get("id")
+        except: return None
+    return val
+
+# Repeat players are the norm, so a warm instance keeps what Upstash confirmed
+# (never a failed read): ids for ID_CACHE_TTL seconds, "not linked" (stored as
+# None) only for NEG_ID_CACHE_TTL so a fresh /link shows up quickly, existing
+# pair-key thread ids (never a missing one) for PAIR_CACHE_TTL. Entries are (expires_at, value)
+# on the monotonic clock; a full cache is simply dropped.
+ID_CACHE_TTL = 300
+NEG_ID_CACHE_TTL = 30
+PAIR_CACHE_TTL = 60
+CACHE_MAX = 4096
+_ID_CACHE: dict = {}
+_PAIR_CACHE: dict = {}
+_MISS = object()
+
+def _cache_get(cache: dict, key: str):
+    hit = cache.get(key)
+    return hit[1] if hit and hit[0] > time.monotonic() else _MISS
+
+def _cache_put(cache: dict, key: str, val, ttl: int):
+    if len(cache) >= CACHE_MAX: cache.clear()
+    cache[key] = (time.monotonic() + ttl, val)
+
+def _resolve_match(n1: str, n2: str, pair_key: str):
+    """[id1, id2, thread_id] for normalized names; whatever isn't cached comes back in one pipeline.
+    None if Upstash couldn't answer: nothing is cached then, and the caller must not guess."""
+    names = (n1, n2)
+    vals = [_cache_get(_ID_CACHE, n) for n in names]
+    if vals[0] is None and vals[1] is None:
+        return [None, None, None]   # both cached as unlinked: the caller skips without a thread
+    vals.append(_cache_get(_PAIR_CACHE, pair_key))
+    keys = (PLK + names[0], PLK + names[1], pair_key)
+    miss = [i for i, v in enumerate(vals) if v is _MISS]
+    if names[0] == names[1] and 1 in miss:
+        miss.remove(1)              # same player twice: one GET serves both
+    if miss:
+        results = _u_pipeline([["GET", keys[i]] for i in miss])
+        if results is None:
+            return None
+        for i, res in zip(miss, results):
+            if i < 2:
+                vals[i] = _parse_link(res)
+                _cache_put(_ID_CACHE, names[i], vals[i], ID_CACHE_TTL if vals[i] else NEG_ID_CACHE_TTL)
+            else:
+                vals[i] = res
+                if res:     # a missing pair may be created by another instance any moment
+                    _cache_put(_PAIR_CACHE, pair_key, res, PAIR_CACHE_TTL)
+        if names[0] == names[1]:
+            vals[1] = vals[0]
+    return vals
+
+# Small shared pool for overlapping independent Upstash/Discord calls
+_POOL = ThreadPoolExecutor(max_workers=4)
 
 # -------- Discord bot API --------
-def _bot_headers():
-    return {
-        "Authorization": f"Bot {DISCORD_BOT_TOKEN}",
-        "Content-Type": "application/json",
-        "Accept": "application/json, */*",
-        "User-Agent": "MatchNotifier (https://github.com/your-repo, 1.0)",
-        "Connection": "close",
-    }
-
-def _discord_json(req, timeout=12):
-    with urllib.request.urlopen(req, timeout=timeout) as r:
-        txt = r.read().decode() or "{}"
-        try: return json.loads(txt)
-        except: return {}
+# A 429 is waited out (up to RATE_LIMIT_RETRIES times) when Discord asks for
+# no more than RATE_LIMIT_MAX_WAIT; longer waits are left to the caller's
+# fallbacks. Without a retry_after the wait backs off exponentially; either
+# way a little jitter keeps parallel calls from retrying in lockstep.
+# Routes that reported an exhausted bucket are held until it resets.
+# All of that waiting shares one RATE_LIMIT_BUDGET per webhook request, so a
+# match (create/unarchive, member adds, post) can't sleep past the function
+# timeout; once it's spent, a 429 goes straight back to the caller.
+RATE_LIMIT_MAX_WAIT = 2.0
+RATE_LIMIT_RETRIES = 3
+RATE_LIMIT_BUDGET = 3.0
+_RESET_AT: dict = {}    # "METHOD /path" -> monotonic time the bucket refills
+_RL_DEADLINE: ContextVar = ContextVar("_RL_DEADLINE", default=0.0)   # 0: no request budget
+
+def _rl_sleep(wait: float) -> bool:
+    """Sleep `wait` seconds if the current request's budget allows it."""
+    deadline = _RL_DEADLINE.get()
+    if deadline and time.monotonic() + wait > deadline:
+        return False
+    time.sleep(wait)
+    return True
+
+def _with_budget(fn):
+    """Carry the caller's rate-limit deadline onto _POOL threads."""
+    deadline = _RL_DEADLINE.get()
+    def run(*args):
+        _RL_DEADLINE.set(deadline)
+        return fn(*args)
+    return run
+
+def _retry_after(r, attempt: int) -> float:
+    # Headers first; the JSON body is only parsed when neither is present
+    hdr = r.headers.get("X-RateLimit-Reset-After") or r.headers.get("Retry-After")
+    try: wait = float(hdr) if hdr else float(_loads(r.data).get("retry_after"))
+    except Exception: wait = 0.2 * 2 ** attempt
+    return wait + random.random() * 0.1
+
+def _discord(method: str, path: str, payload=None, timeout=None):
+    body = payload if payload is None or isinstance(payload, bytes) else _dumps(payload)
+    kw = {"timeout": timeout} if timeout else {}
+    route = f"{method} {path.split('?', 1)[0]}"
+    wait = _RESET_AT.get(route, 0) - time.monotonic()
+    if wait > 0 and (wait > RATE_LIMIT_MAX_WAIT or not _rl_sleep(wait)):
+        # Bucket is still empty past what this request may wait; sending now
+        # would only earn a real 429, so answer with one locally instead
+        log.warning("[discord] %s held for %.2fs, not sending", route, wait)
+        return urllib3.HTTPResponse(body=_dumps({"message": "rate limited (held)", "retry_after": wait}),
+                                    status=429, headers={"Retry-After": f"{wait:.3f}"},
+                                    preload_content=True)
+    r = _DISCORD.request(method, DISCORD_API + path, body=body, **kw)
+    for attempt in range(RATE_LIMIT_RETRIES):
+        if r.status != 429:
+            break
+        wait = _retry_after(r, attempt)
+        log.warning("[discord] 429 on %s, retry_after=%.2f", route, wait)
+        if wait > RATE_LIMIT_MAX_WAIT or not _rl_sleep(wait):
+            break
+        r = _DISCORD.request(method, DISCORD_API + path, body=body, **kw)
+    if r.headers.get("X-RateLimit-Remaining") == "0":
+        try: reset_after = float(r.headers.get("X-RateLimit-Reset-After"))
+        except Exception: reset_after = 0
+        if len(_RESET_AT) >= CACHE_MAX: _RESET_AT.clear()
+        _RESET_AT[route] = time.monotonic() + reset_after
+    return r
+
+def _discord_json(r):
+    try: return _loads(r.data or b"{}")
+    except: return {}
+
+# Every message has the same shape, so only the content is encoded per post
+_MSG_HEAD = b'{"content":'
+_MSG_TAIL = b',"allowed_mentions":{"parse":["users"]}}'
+
+def _message_body(content: str) -> bytes:
+    return _MSG_HEAD + encode_basestring(content).encode("utf-8") + _MSG_TAIL
 
 def _post_message(channel_id: str, content: str):
-    url = f"https://discord.com/api/v10/channels/{channel_id}/messages"
-    body = {"content": content, "allowed_mentions": {"parse": ["users"]}}
-    req = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"), method="POST", headers=_bot_headers())
-    try:
-        obj = _discord_json(req)
-        print(f"[discord] posted in {channel_id}: {obj.get('id')}")
-        return obj
-    except urllib.error.HTTPError as e:
-        print(f"[discord] post HTTPError {e.code} {e.read().decode(errors='replace')}", file=sys.stderr)
+    r = _discord("POST", f"/channels/{channel_id}/messages", _message_body(content))
+    if r.status >= 400:
+        log.warning("[discord] post HTTPError %s %s", r.status, r.data.decode(errors='replace'))
         return None
+    obj = _discord_json(r)
+    log.info("[discord] posted in %s: %s", channel_id, obj.get("id"))
+    return obj
 
 def _post_webhook(content: str):
-    if not DISCORD_WEBHOOK:
+    if not _WEBHOOK:
         return None
-    try:
-        # If env contains full webhook URL, use as-is
-        url = DISCORD_WEBHOOK
-        body = {"content": content, "allowed_mentions": {"parse": ["users"]}}
-        req = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"), method="POST",
-                                     headers={"Content-Type": "application/json", "Accept": "application/json"})
-        with urllib.request.urlopen(req, timeout=12) as r:
-            txt = r.read().decode() or "{}"
-            try:
-                obj = json.loads(txt)
-            except:
-                obj = {"raw": txt}
-            print(f"[discord-webhook] posted: status={r.status}")
-            return obj
-    except urllib.error.HTTPError as e:
-        print(f"[discord-webhook] HTTPError {e.code} {e.read().decode(errors='replace')}", file=sys.stderr)
+    # If env contains full webhook URL, use as-is
+    r = _WEBHOOK.request("POST", _WEBHOOK_URL.request_uri, body=_message_body(content),
+                         headers={"Content-Type": "application/json", "Accept": "application/json"})
+    if r.status >= 400:
+        log.warning("[discord-webhook] HTTPError %s %s", r.status, r.data.decode(errors='replace'))
         return None
+    try:
+        obj = _loads(r.data or b"{}")
+    except:
+        obj = {"raw": r.data.decode(errors="replace")}
+    log.info("[discord-webhook] posted: status=%s", r.status)
+    return obj
 
 def _delete_message(channel_id: str, message_id: str):
-    import urllib.error
-    url = f"https://discord.com/api/v10/channels/{channel_id}/messages/{message_id}"
-    req = urllib.request.Request(url, method="DELETE", headers=_bot_headers())
-    try:
-        with urllib.request.urlopen(req, timeout=10) as r:
-            print(f"[discord] delete {message_id} -> {r.status}")
-            return True
-    except urllib.error.HTTPError as e:
-        body = e.read().decode(errors="replace")
-        print(f"[discord] delete HTTPError {e.code} {body}", file=sys.stderr)
-        return e.code == 404
+    r = _discord("DELETE", f"/channels/{channel_id}/messages/{message_id}", timeout=10)
+    if r.status >= 400:
+        log.warning("[discord] delete HTTPError %s %s", r.status, r.data.decode(errors='replace'))
+        return r.status == 404
+    log.info("[discord] delete %s -> %s", message_id, r.status)
+    return True
 
 def _list_messages(channel_id: str, limit: int = 100, before: str | None = None):
     qs = {"limit": str(min(max(limit, 1), 100))}
     if before:
         qs["before"] = before
-    url = f"https://discord.com/api/v10/channels/{channel_id}/messages?{urllib.parse.urlencode(qs)}"
-    req = urllib.request.Request(url, headers=_bot_headers(), method="GET")
-    try:
-        return _discord_json(req) or []
-    except urllib.error.HTTPError as e:
-        print(f"[lfg] list messages HTTPError {e.code} {e.read().decode(errors='replace')}", file=sys.stderr)
+    r = _discord("GET", f"/channels/{channel_id}/messages?{urllib.parse.urlencode(qs)}")
+    if r.status >= 400:
+        log.warning("[lfg] list messages HTTPError %s %s", r.status, r.data.decode(errors='replace'))
         return []
+    return _discord_json(r) or []
 
 # -------- Threads (create/unarchive/add) --------
 def _create_private_thread(name: str):
-    url = f"https://discord.com/api/v10/channels/{DISCORD_CHANNEL_ID}/threads"
     durations = [THREAD_AUTO_ARCHIVE_MIN, 1440, 4320, 10080]
     for dur in durations:
         payload = {"name": name[:96], "type": 12, "auto_archive_duration": int(dur), "invitable": False}
-        req = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"),
-                                     method="POST", headers=_bot_headers())
-        try:
-            obj = _discord_json(req)
-            if obj.get("id"):
-                print(f"[thread] created '{name}' -> {obj.get('id')} (dur={dur})")
-                return obj
-        except urllib.error.HTTPError as e:
-            print(f"[thread] create HTTPError {e.code} (dur={dur}) {e.read().decode(errors='replace')}", file=sys.stderr)
+        r = _discord("POST", f"/channels/{DISCORD_CHANNEL_ID}/threads", payload)
+        if r.status >= 400:
+            log.warning("[thread] create HTTPError %s (dur=%s) %s", r.status, dur, r.data.decode(errors='replace'))
+            if r.status == 429: break   # another duration won't help a rate limit
             continue
+        obj = _discord_json(r)
+        if obj.get("id"):
+            log.info("[thread] created '%s' -> %s (dur=%s)", name, obj.get("id"), dur)
+            return obj
     return None
 
 def _ensure_unarchived(thread_id: str):
-    url = f"https://discord.com/api/v10/channels/{thread_id}"
     durations = [THREAD_AUTO_ARCHIVE_MIN, 1440, 4320, 10080]
     for dur in durations:
         payload = {"archived": False, "locked": False, "auto_archive_duration": int(dur)}
-        req = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"),
-                                     method="PATCH", headers=_bot_headers())
-        try:
-            _discord_json(req)
-            print(f"[thread] unarchived {thread_id} (dur={dur})")
-            return True
-        except urllib.error.HTTPError as e:
-            print(f"[thread] unarchive HTTPError {e.code} (dur={dur}) {e.read().decode(errors='replace')}", file=sys.stderr)
+        r = _discord("PATCH", f"/channels/{thread_id}", payload)
+        if r.status >= 400:
+            log.warning("[thread] unarchive HTTPError %s (dur=%s) %s", r.status, dur, r.data.decode(errors='replace'))
+            if r.status == 429: break   # another duration won't help a rate limit
             continue
+        log.info("[thread] unarchived %s (dur=%s)", thread_id, dur)
+        return True
     return False
 
 def _add_thread_member(thread_id: str, user_id: str):
     if not (thread_id and user_id): return False
-    url = f"https://discord.com/api/v10/channels/{thread_id}/thread-members/{user_id}"
-    req = urllib.request.Request(url, method="PUT", headers=_bot_headers())
-    try:
-        with urllib.request.urlopen(req, timeout=10) as r:
-            print(f"[thread] add member {user_id} -> {r.status}")
-            return True
-    except urllib.error.HTTPError as e:
-        print(f"[thread] add member HTTPError {e.code} {e.read().decode(errors='replace')}", file=sys.stderr)
-        return e.code == 409
+    r = _discord("PUT", f"/channels/{thread_id}/thread-members/{user_id}", timeout=10)
+    if r.status >= 400:
+        log.warning("[thread] add member HTTPError %s %s", r.status, r.data.decode(errors='replace'))
+        return r.status == 409
+    log.info("[thread] add member %s -> %s", user_id, r.status)
+    return True
+
+def _join_and_post(thread_id: str, user_ids, content: str):
+    # Both adds are independent; the post waits for them so the mentions land
+    # on members, not on users who'd first see the thread without a ping.
+    add = _with_budget(_add_thread_member)
+    adds = [_POOL.submit(add, thread_id, uid) for uid in dict.fromkeys(user_ids) if uid]
+    for f in adds: f.result()
+    return _post_message(thread_id, content)
 
 # -------- Pair key --------
-def _pair_key(p1: str, p2: str) -> str:
-    a, b = sorted([p1.strip().lower(), p2.strip().lower()])
-    return f"threadpair:{a}|{b}"
+def _pair_key(n1: str, n2: str) -> str:
+    """Order-independent key for two already stripped and lowercased names."""
+    return f"threadpair:{n1}|{n2}" if n1 <= n2 else f"threadpair:{n2}|{n1}"
 
 # -------- LFG helpers --------
 def _lfg_key(channel_id: str) -> str:
@@ -243,39 +427,85 @@ def _ensure_lfg_message(channel_id: str, content: str = None):
     content = content or LFG_MESSAGE_TEXT
     msg_id = _u_get(_lfg_key(channel_id))
     if msg_id:
-        print(f"[lfg] exists {channel_id} -> {msg_id}")
+        log.info("[lfg] exists %s -> %s", channel_id, msg_id)
         return {"ok": True, "status": "exists", "message_id": msg_id}
     obj = _post_message(channel_id, content)
     if obj and obj.get("id"):
         _u_set(_lfg_key(channel_id), obj["id"])
-        print(f"[lfg] created {channel_id} -> {obj['id']}")
+        log.info("[lfg] created %s -> %s", channel_id, obj["id"])
         return {"ok": True, "status": "created", "message_id": obj["id"]}
-    print("[lfg] failed to create", file=sys.stderr)
+    log.warning("[lfg] failed to create")
     return {"ok": False, "status": "error"}
 
+# Bulk delete only accepts 2-100 ids, none older than 14 days (kept an hour clear).
+DISCORD_EPOCH_MS = 1420070400000
+BULK_MAX_AGE_MS  = (14 * 24 - 1) * 3600 * 1000
+# A tracked banner younger than this is trusted to be the only one
+LFG_FRESH_MS     = 3600 * 1000
+
+def _bulk_delete(channel_id: str, ids) -> int:
+    """Delete `ids` in bulk where Discord allows it, one by one otherwise; returns how many went."""
+    cutoff = int(time.time() * 1000) - BULK_MAX_AGE_MS
+    recent, single = [], []
+    for i in ids:
+        (recent if (int(i) >> 22) + DISCORD_EPOCH_MS > cutoff else single).append(i)
+    deleted = 0
+    for n in range(0, len(recent), 100):
+        chunk = recent[n:n + 100]
+        if len(chunk) < 2:
+            single += chunk; continue
+        r = _discord("POST", f"/channels/{channel_id}/messages/bulk-delete", {"messages": chunk})
+        if r.status >= 400:
+            # e.g. no Manage Messages permission: the bot can still delete its own one by one
+            log.warning("[discord] bulk delete HTTPError %s %s", r.status, r.data.decode(errors='replace'))
+            single += chunk; continue
+        log.info("[discord] bulk deleted %s in %s", len(chunk), channel_id)
+        deleted += len(chunk)
+    return deleted + sum(_POOL.map(_with_budget(lambda mid: _delete_message(channel_id, mid)), single))
+
+def _token_user_id(token: str):
+    """A bot token's first segment is the bot's user id in unpadded base64."""
+    try:
+        seg = token.split(".", 1)[0]
+        uid = base64.b64decode(seg + "=" * (-len(seg) % 4)).decode()
+        return uid if uid.isdigit() else None
+    except Exception:
+        return None
+
+# Only the bot's own messages can be banners; None disables the author check
+_BOT_ID = _token_user_id(DISCORD_BOT_TOKEN)
+
 def _clear_lfg_message(channel_id: str, content: str = None):
-    content = content or LFG_MESSAGE_TEXT
+    content = (content or LFG_MESSAGE_TEXT).strip()
     tracked_id = _u_get(_lfg_key(channel_id))
-    if tracked_id:
-        _delete_message(channel_id, tracked_id)
+    try: tracked_ms = (int(tracked_id) >> 22) + DISCORD_EPOCH_MS
+    except (TypeError, ValueError):
+        if tracked_id: log.warning("[lfg] ignoring bad pointer %r", tracked_id)
+        tracked_id, tracked_ms = None, 0    # missing or corrupt: the scan below finds the banner
+    if tracked_id and _delete_message(channel_id, tracked_id) and \
+            tracked_ms > int(time.time() * 1000) - LFG_FRESH_MS:
+        # A recent pointer that deleted cleanly: no strays to hunt for
+        _u_del(_lfg_key(channel_id))
+        log.info("[lfg] deleted tracked %s", tracked_id)
+        return {"ok": True, "status": "deleted_all", "deleted": 1}
 
     MAX_PAGES = 5
     before = None
-    total_deleted = 0
+    ids = []
     for _ in range(MAX_PAGES):
         msgs = _list_messages(channel_id, limit=100, before=before)
         if not msgs:
             break
-        for m in msgs:
-            if (m.get("content") or "") == content:
-                if _delete_message(channel_id, m.get("id", "")):
-                    total_deleted += 1
+        ids += [m["id"] for m in msgs
+                if m.get("id") and (not _BOT_ID or (m.get("author") or {}).get("id") == _BOT_ID)
+                and (m.get("content") or "").strip() == content]
         before = msgs[-1]["id"] if msgs else None
         if not before:
             break
 
+    total_deleted = _bulk_delete(channel_id, ids) if ids else 0
     _u_del(_lfg_key(channel_id))
-    print(f"[lfg] deleted all occurrences: {total_deleted}")
+    log.info("[lfg] deleted all occurrences: %s", total_deleted)
     return {"ok": True, "status": "deleted_all", "deleted": total_deleted}
 
 # -------- Request handler --------
@@ -284,30 +514,33 @@ class handler(BaseHTTPRequestHandler):
         _respond(self, 200, {"ok": True, "message": "webhook up"})
 
     def do_POST(self):
+        _RL_DEADLINE.set(time.monotonic() + RATE_LIMIT_BUDGET)
         try:
             # Basic ingress diagnostics
             recv_secret = self.headers.get("X-Shared-Secret", "")
-            if SHARED_SECRET and recv_secret != SHARED_SECRET:
-                try:
-                    print(f"[ingress] unauthorized /api/showdown from {self.client_address[0]} secret_len={len(recv_secret)}", file=sys.stderr)
-                except Exception:
-                    pass
+            if SHARED_SECRET and not hmac.compare_digest(recv_secret.encode(), SHARED_SECRET.encode()):
+                log.warning("[ingress] unauthorized /api/showdown from %s secret_len=%s", self.client_address[0], len(recv_secret))
                 return _respond(self, 401, {"error": "unauthorized"})
 
-            length = int(self.headers.get("Content-Length", "0") or 0)
-            raw = self.rfile.read(length) if length else b"{}"
-            if self.headers.get("Content-Transfer-Encoding") == "base64":
-                raw = base64.b64decode(raw)
+            try: n = int(self.headers["Content-Length"])
+            except (KeyError, TypeError, ValueError): n = -1
+            if n < 0:
+                return _respond(self, 411, {"error": "length required"})
+            if n > MAX_BODY:
+                return _respond(self, 413, {"error": "body too large"})
+            raw = self.rfile.read(n)
             try:
-                data = json.loads(raw.decode("utf-8"))
+                if raw and self.headers.get("Content-Transfer-Encoding") == "base64":
+                    raw = base64.b64decode(raw)
+                data = _loads(raw) if raw else {}
             except Exception:
+                data = None
+            if not isinstance(data, dict):
                 return _respond(self, 400, {"error": "invalid json"})
 
             service = (data.get("service") or "").strip().lower()
-            try:
-                print(f"[ingress] showdown len={length} ct={self.headers.get('Content-Type','')} service='{service}' keys={list(data.keys())}")
-            except Exception:
-                pass
+            log.debug("[ingress] showdown len=%s ct=%s service='%s' keys=%s",
+                     len(raw), self.headers.get("Content-Type", ""), service, list(data))
 
             # --- auto-LFG & queue analytics logging
             if service == "queuestatus":
@@ -326,9 +559,8 @@ class handler(BaseHTTPRequestHandler):
                     # Queue analytics: start session if not active
                     now = int(time.time())
                     if _u_get(Q_ACTIVE_KEY) != "1":
-                        _u_set(Q_ACTIVE_KEY, "1")
-                        _u_set(Q_STARTED_AT, str(now))
-                        print(f"[queue] started at {now}")
+                        _u_pipeline([["SET", Q_ACTIVE_KEY, "1"], ["SET", Q_STARTED_AT, str(now)]])
+                        log.info("[queue] started at %s", now)
                     return _respond(self, 200, {"ok": True, "lfg": banner, "queue":"on"})
                 else:
                     # LFG off: delete all banners
@@ -339,17 +571,19 @@ class handler(BaseHTTPRequestHandler):
 
                     # Queue analytics: close session if active and store duration
                     now = int(time.time())
-                    if _u_get(Q_ACTIVE_KEY) == "1":
+                    active, started = _u_pipeline([["GET", Q_ACTIVE_KEY], ["GET", Q_STARTED_AT]]) or (None, None)
+                    if active == "1":
                         try:
-                            start = int(_u_get(Q_STARTED_AT) or "0")
+                            start = int(started or "0")
                         except:
                             start = 0
+                        cmds = [["DEL", Q_ACTIVE_KEY, Q_STARTED_AT]]
                         if start > 0 and now >= start:
                             duration = now - start
-                            blob = json.dumps({"start": start, "end": now, "dur": duration})
-                            _u_zadd(Q_ZSET, now, blob)
-                            print(f"[queue] ended at {now} (dur={duration}s)")
-                        _u_del(Q_ACTIVE_KEY); _u_del(Q_STARTED_AT)
+                            blob = _dumps({"start": start, "end": now, "dur": duration}).decode()
+                            cmds.insert(0, ["ZADD", Q_ZSET, str(now), blob])
+                            log.info("[queue] ended at %s (dur=%ss)", now, duration)
+                        _u_pipeline(cmds)
                     return _respond(self, 200, {"ok": True, "lfg": cleared, "queue":"off"})
 
             # --- Default: match flow (as before)
@@ -358,8 +592,14 @@ class handler(BaseHTTPRequestHandler):
             if not p1 or not p2:
                 return _respond(self, 400, {"error": "missing player names"})
 
-            id1, id2 = _lookup_discord_id(p1), _lookup_discord_id(p2)
-            print(f"[step] resolved IDs: {p1}={id1 or 'N/A'}, {p2}={id2 or 'N/A'}")
+            n1, n2 = p1.lower(), p2.lower()
+            pair_key = _pair_key(n1, n2)
+            resolved = _resolve_match(n1, n2, pair_key)
+            if resolved is None:
+                # Without the pair key we could open a duplicate thread; let the sender retry
+                return _respond(self, 503, {"error": "link storage unavailable"})
+            id1, id2, thread_id = resolved
+            log.debug("[step] resolved IDs: %s=%s, %s=%s", p1, id1 or "N/A", p2, id2 or "N/A")
 
             if not (id1 or id2):
                 return _respond(self, 200, {"ok": True, "skipped": "no_linked_players"})
@@ -369,13 +609,10 @@ class handler(BaseHTTPRequestHandler):
             content = f"🎮 New game started! {m1} vs {m2}"
             thread_name = f"{p1} vs {p2}"
 
-            pair_key = _pair_key(p1, p2)
-            thread_id = _u_get(pair_key)
             if thread_id and _ensure_unarchived(thread_id):
-                if id1: _add_thread_member(thread_id, id1)
-                if id2: _add_thread_member(thread_id, id2)
-                _post_message(thread_id, content)
+                _join_and_post(thread_id, (id1, id2), content)
                 return _respond(self, 200, {"ok": True, "posted_in": "existing_thread", "thread_id": thread_id})
+            _PAIR_CACHE.pop(pair_key, None)  # stale or unusable thread
 
             # If bot channel/thread creation is unavailable, fallback to a simple webhook post
             if not DISCORD_CHANNEL_ID:
@@ -392,13 +629,11 @@ class handler(BaseHTTPRequestHandler):
                     return _respond(self, 200, {"ok": True, "posted_in": "webhook"})
                 return _respond(self, 500, {"error": "failed to create thread"})
             thread_id = th["id"]
-            _u_set(pair_key, thread_id)
-            if id1: _add_thread_member(thread_id, id1)
-            if id2: _add_thread_member(thread_id, id2)
-            _post_message(thread_id, content)
+            if _u_set(pair_key, thread_id):
+                _cache_put(_PAIR_CACHE, pair_key, thread_id, PAIR_CACHE_TTL)
+            _join_and_post(thread_id, (id1, id2), content)
             return _respond(self, 200, {"ok": True, "posted_in": "new_thread", "thread_id": thread_id})
 
         except Exception:
-            tb = traceback.format_exc()
-            print("[fatal]\n" + tb, file=sys.stderr)
+            log.exception("[fatal]")
             return _respond(self, 500, {"error": "crash"})